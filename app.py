@@ -2,178 +2,215 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import requests
-from bs4 import BeautifulSoup
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.html
+from lxml import etree
+import threading
 import re
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 予想対象のレース番号
+RACE_NUMBERS = list(range(1, 13))
 
 # JRA全10場
 JRA_VENUES = ["札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
 
+# 競馬ブック前走欄の開催場略称
+JRA_VENUE_MAP = {"東":"東京", "中":"中山", "京":"京都", "阪":"阪神", "名":"中京", "新":"新潟", "福":"福島", "小":"小倉", "札":"札幌", "函":"函館"}
+LOCAL_VENUE_MAP = {"盛":"盛岡", "水":"水沢", "浦":"浦和", "船":"船橋", "大":"大井", "川":"川崎", "金":"金沢", "笠":"笠松", "園":"園田", "姫":"姫路", "高":"高知", "佐":"佐賀"}
+VENUE_ABBR_MAP = {**JRA_VENUE_MAP, **LOCAL_VENUE_MAP}
+
+# 前走データは場・芝ダ・馬場を整数コードで持つ（場は0〜9がJRA、以降が地方、-1は不明）
+VENUE_CODES = {venue: i for i, venue in enumerate(JRA_VENUES + list(LOCAL_VENUE_MAP.values()))}
+TRACK_CODES = {"芝": 0, "ダート": 1}
+CONDITION_CODES = {"良": 0, "稍": 1, "重": 2, "不良": 3}
+
+# 馬番の丸数字表記（①=1 …）
+CIRCLED_NUMBERS = tuple(chr(9311 + i) for i in range(40))
+
+# テン3Fが取れない馬の最大テンスピード（m/s）
+DEFAULT_EARLY_SPEED = 16.0
+
+# テン3Fに影響するコース形態
+TURF_START_DIRT = frozenset({("東京", 1600), ("中山", 1200), ("阪神", 1400), ("京都", 1400), ("新潟", 1200), ("中京", 1400)})
+UPHILL_STARTS = frozenset({("中山", 2000, "芝"), ("阪神", 2000, "芝"), ("中京", 2000, "芝")})
+DOWNHILL_STARTS = frozenset({("京都", 1400, "芝"), ("京都", 1600, "芝"), ("新潟", 1000, "芝")})
+
+# (場コード, 距離, 芝ダコード) → コース補正（3種のコースは重複しないので1回の参照で済む）
+COURSE_MODS = {
+    **{(VENUE_CODES[venue], dist, TRACK_CODES["ダート"]): -0.15 for venue, dist in TURF_START_DIRT},
+    **{(VENUE_CODES[venue], dist, TRACK_CODES[track]): +0.15 for venue, dist, track in UPHILL_STARTS},
+    **{(VENUE_CODES[venue], dist, TRACK_CODES[track]): -0.15 for venue, dist, track in DOWNHILL_STARTS},
+}
+
+# 馬場状態補正 [芝, ダート][良, 稍, 重, 不良]
+CONDITION_MODS = np.array([
+    [0.0, +0.05, +0.15, +0.15],
+    [0.0, -0.05, -0.15, -0.15],
+])
+
+# 外枠有利なコース
+OUTSIDE_ADV_COURSES = frozenset({("中山", 1200, "ダート"), ("東京", 1600, "ダート"), ("阪神", 1400, "ダート"), ("京都", 1400, "ダート")})
+
+# 前走データ1走分のレコード型（馬ごとに1本の構造化配列として保持）
+PAST_DTYPE = np.dtype([
+    ('venue_code', 'i1'), ('track_type_code', 'i1'), ('distance', 'i4'), ('condition_code', 'i1'),
+    ('finish_position', 'i4'), ('popularity', 'i4'), ('early_3f', 'f8'),
+    ('first_corner_pos', 'i4'), ('is_late_start', '?'), ('past_frame', 'i4'), ('weight', 'f8'),
+])
+
 # ==========================================
 # 1. ペース解析・展開予想のコアロジック
 # ==========================================
 
-def calculate_early_pace_speed(row, current_dist):
-    if pd.isna(row.get('early_3f')):
-        return np.nan
-    
-    raw_speed = 600.0 / row['early_3f']
+def is_jra_venue(venue_code):
+    return (venue_code >= 0) & (venue_code < len(JRA_VENUES))
+
+def calculate_early_pace_speed(past, current_dist):
+    venue_code = past['venue_code']
+    track_type_code = past['track_type_code']
+    distance = past['distance']
+    n = len(distance)
+
+    raw_speed = 600.0 / past['early_3f']
     
     # 地方競馬のテン時計割引（過剰にならないよう -0.3 に調整）
-    if row['venue'] not in JRA_VENUES:
-        raw_speed -= 0.3
-
-    condition_mod = 0.0
-    if row['track_type'] == "芝":
-        if row['track_condition'] in ["重", "不良"]: condition_mod = +0.15 
-        elif row['track_condition'] == "稍": condition_mod = +0.05
-    elif row['track_type'] == "ダート":
-        if row['track_condition'] in ["重", "不良"]: condition_mod = -0.15 
-        elif row['track_condition'] == "稍": condition_mod = -0.05
-
-    course_mod = 0.0
-    turf_start_dirt = [("東京", 1600), ("中山", 1200), ("阪神", 1400), ("京都", 1400), ("新潟", 1200), ("中京", 1400)]
-    if row['track_type'] == "ダート" and (row['venue'], row['distance']) in turf_start_dirt:
-        course_mod += -0.15
-        
-    uphill_starts = [("中山", 2000, "芝"), ("阪神", 2000, "芝"), ("中京", 2000, "芝")]
-    if (row['venue'], row['distance'], row['track_type']) in uphill_starts:
-        course_mod += +0.15
+    raw_speed = raw_speed - np.where(is_jra_venue(venue_code), 0.0, 0.3)
 
-    downhill_starts = [("京都", 1400, "芝"), ("京都", 1600, "芝"), ("新潟", 1000, "芝")]
-    if (row['venue'], row['distance'], row['track_type']) in downhill_starts:
-        course_mod += -0.15
+    condition_mod = CONDITION_MODS[track_type_code, past['condition_code']]
+
+    courses = zip(venue_code.tolist(), distance.tolist(), track_type_code.tolist())
+    course_mod = np.fromiter((COURSE_MODS.get(c, 0.0) for c in courses), dtype=np.float64, count=n)
 
     # 距離バイアスの「隠し味化」（極端な補正を緩和）
-    dist_diff = row['distance'] - current_dist
-    distance_mod = 0.0
-    if dist_diff > 0:
-        # 距離短縮: 追走苦労のマイナス補正をマイルドに (-0.05)
-        distance_mod = -(dist_diff / 100.0) * 0.05
-    elif dist_diff < 0:
-        # 距離延長: スピードの過大評価を防ぐ補正をマイルドに (-0.10)
-        distance_mod = -(abs(dist_diff) / 100.0) * 0.10
+    dist_diff = distance - current_dist
+    # 距離短縮: 追走苦労のマイナス補正をマイルドに (-0.05)
+    # 距離延長: スピードの過大評価を防ぐ補正をマイルドに (-0.10)
+    distance_mod = np.where(dist_diff > 0, -(dist_diff / 100.0) * 0.05, -(np.abs(dist_diff) / 100.0) * 0.10)
 
     return raw_speed + condition_mod + course_mod + distance_mod
 
-def determine_running_style(past_df: pd.DataFrame) -> str:
-    if past_df.empty: return "不明"
+def analyze_past_races(past, valid, current_venue: str, current_dist):
+    # 全馬の前走（馬数×走数）から、脚質・騎手の狙う位置・最大テンスピードを一度に集計する
+    finish = past['finish_position']
+    corners = past['first_corner_pos']
+    n_past = valid.sum(axis=1)
+    rows = np.arange(len(past))
     
-    is_good_run = (past_df['finish_position'] <= 3) | ((past_df['popularity'] > past_df['finish_position']) & (past_df['finish_position'] <= 5))
-    good_runs = past_df[is_good_run]
+    is_top3 = valid & (finish <= 3)
+    beat_popularity = valid & (past['popularity'] > finish)
+    is_good_run = is_top3 | (beat_popularity & (finish <= 5))
+    is_success = is_top3 | beat_popularity
     
-    if good_runs.empty: return "不明"
-        
-    good_positions = good_runs['first_corner_pos'].tolist()
+    # 脚質: 好走時の1角位置から判定
+    running_style = np.select(
+        [
+            ~is_good_run.any(axis=1),
+            (~is_good_run | (corners == 1)).all(axis=1),
+            (is_good_run & (corners >= 2) & (corners <= 5)).any(axis=1),
+        ],
+        ["不明", "ハナ絶対", "控えOK"],
+        default="差し追込",
+    )
     
-    if all(pos == 1 for pos in good_positions):
-        return "ハナ絶対"
-        
-    if any(2 <= pos <= 5 for pos in good_positions):
-        return "控えOK"
-        
-    return "差し追込"
-
-def extract_jockey_target_position(past_races_df: pd.DataFrame, current_venue: str) -> float:
-    if past_races_df.empty: return 9.5 
+    # 騎手の狙う位置: 同場での好走 → 好走 → 平均1角位置 の順
+    venue_success = is_success & (past['venue_code'] == VENUE_CODES.get(current_venue, -1))
+    mean_corner = np.where(valid, corners, 0).sum(axis=1) / np.maximum(n_past, 1)
+    jockey_target = np.select(
+        [venue_success.any(axis=1), is_success.any(axis=1), n_past > 0],
+        [corners[rows, venue_success.argmax(axis=1)], corners[rows, is_success.argmax(axis=1)], mean_corner],
+        default=9.5,
+    ).astype(np.float64)
     
-    is_success = (past_races_df['finish_position'] <= 3) | (past_races_df['popularity'] > past_races_df['finish_position'])
-    is_same_venue = past_races_df['venue'] == current_venue
+    # 前走なし・テン3F不明の馬は NaN
+    early_speed = calculate_early_pace_speed(past.ravel(), current_dist).reshape(past.shape)
+    max_speed = np.fmax.reduce(np.where(valid, early_speed, np.nan), axis=1)
     
-    venue_success_races = past_races_df[is_success & is_same_venue]
-    if not venue_success_races.empty:
-        return float(venue_success_races.iloc[0]['first_corner_pos'])
-    
-    success_races = past_races_df[is_success]
-    if not success_races.empty:
-        return float(success_races.iloc[0]['first_corner_pos'])
-        
-    return float(past_races_df['first_corner_pos'].mean())
+    return running_style, jockey_target, max_speed
 
-def calculate_pace_score(horse, current_dist, current_venue, current_track, total_horses):
-    past_df = pd.DataFrame(horse['past_races'])
-    
-    if past_df.empty: 
-        horse['condition_mod'] = 0.0
-        horse['special_flag'] = "❓データ不足"
-        horse['max_early_speed'] = 16.0
-        horse['running_style'] = "不明"
-        return 10.0 + ((horse['horse_number'] - 1) * 0.05) 
+def calculate_pace_scores(horses, current_dist, current_venue, current_track):
+    total_horses = len(horses)
+    horse_number = np.array([h['horse_number'] for h in horses])
+    current_weight = np.array([h['current_weight'] for h in horses], dtype=np.float64)
     
-    horse['running_style'] = determine_running_style(past_df)
+    # 馬ごとに走数の異なる前走を、(馬数, 最大走数) の配列に詰める
+    n_past = np.array([h['past_races'].size for h in horses])
+    past = np.zeros((total_horses, max(1, n_past.max())), dtype=PAST_DTYPE)
+    past['early_3f'] = np.nan
+    for i, h in enumerate(horses):
+        past[i, :n_past[i]] = h['past_races']
+    valid = np.arange(past.shape[1]) < n_past[:, None]
+    has_past = n_past > 0
     
-    past_df['early_speed'] = past_df.apply(lambda row: calculate_early_pace_speed(row, current_dist), axis=1)
-    max_speed = past_df['early_speed'].max()
-    horse['max_early_speed'] = max_speed if not pd.isna(max_speed) else 16.0
+    running_style, jockey_target, max_speed = analyze_past_races(past, valid, current_venue, current_dist)
     
+    # テン3F不明の場合は基準値(16.8)扱いとなり、スピード補正は0
     speed_multiplier = 4.0 if (current_track == "ダート" and current_dist <= 1400) else 3.0
-    speed_advantage = 0.0
-    if not pd.isna(max_speed):
-        speed_advantage = (16.8 - max_speed) * speed_multiplier 
-
-    jockey_target = extract_jockey_target_position(past_df, current_venue)
+    speed_advantage = (16.8 - np.where(np.isnan(max_speed), 16.8, max_speed)) * speed_multiplier
     base_position = (jockey_target * 0.6) + speed_advantage
     
-    last_race = past_df.iloc[0]
-    weight_modifier = (horse['current_weight'] - last_race['weight']) * 0.25
+    last_race = past[:, 0]
+    weight_diff = current_weight - last_race['weight']
+    weight_modifier = weight_diff * 0.25
     
-    base_mod = (horse['horse_number'] - 1) * 0.05 
-    outside_adv_courses = [("中山", 1200, "ダート"), ("東京", 1600, "ダート"), ("阪神", 1400, "ダート"), ("京都", 1400, "ダート")]
-    if (current_venue, current_dist, current_track) in outside_adv_courses:
-        base_mod = (total_horses - horse['horse_number']) * 0.02 - 0.15
+    base_mod = (horse_number - 1) * 0.05 
+    if (current_venue, current_dist, current_track) in OUTSIDE_ADV_COURSES:
+        base_mod = (total_horses - horse_number) * 0.02 - 0.15
 
-    late_start_penalty = 0.0
-    horse['special_flag'] = ""
+    can_wait = running_style != "ハナ絶対"
     
     # 前走地方競馬ペナルティ（+2.5 → +1.0へ緩和）
-    if last_race['venue'] not in JRA_VENUES:
-        late_start_penalty += 1.0
-        horse['special_flag'] = "⚠️前走地方"
-
+    is_prev_local = has_past & ~is_jra_venue(last_race['venue_code'])
     # 距離延長（過剰なペナルティを撤廃し、+0.5の微調整に）
-    if last_race['distance'] < current_dist and horse['running_style'] != "ハナ絶対":
-        late_start_penalty += 0.5
-        prefix = horse['special_flag'] + " " if horse['special_flag'] else ""
-        horse['special_flag'] = (prefix + "🐎距離延長(控える可能性)").strip()
-
+    is_extension = has_past & (last_race['distance'] < current_dist) & can_wait
     # 距離短縮（過剰なペナルティを撤廃し、+0.3の微調整に）
-    if last_race['distance'] > current_dist:
-        late_start_penalty += 0.3
-        prefix = horse['special_flag'] + " " if horse['special_flag'] else ""
-        horse['special_flag'] = (prefix + "🐢距離短縮(追走注意)").strip()
-
-    if last_race.get('is_late_start', False):
-        late_start_penalty += 1.0 
-        if last_race['first_corner_pos'] <= 5:
-            is_past_outside = last_race['past_frame'] >= 5
-            is_current_inside = horse['horse_number'] <= (total_horses / 2) 
-            
-            if is_past_outside and is_current_inside:
-                late_start_penalty += 1.5
-                prefix = horse['special_flag'] + " " if horse['special_flag'] else ""
-                horse['special_flag'] = (prefix + "⚠️内枠包まれ懸念").strip()
-            elif is_past_outside and not is_current_inside:
-                late_start_penalty -= 0.5
-                prefix = horse['special_flag'] + " " if horse['special_flag'] else ""
-                horse['special_flag'] = (prefix + "🐎外枠リカバー警戒").strip()
-
-    # 外枠（外から5頭くらい）の様子見・控えるロジック
-    is_outer_5 = horse['horse_number'] > (total_horses - 5)
-    weight_diff = horse['current_weight'] - last_race['weight']
+    is_shortening = has_past & (last_race['distance'] > current_dist)
+    
+    is_late_start = has_past & last_race['is_late_start']
+    is_late_front = is_late_start & (last_race['first_corner_pos'] <= 5) & (last_race['past_frame'] >= 5)
+    is_current_inside = horse_number <= (total_horses / 2)
+    is_boxed_in = is_late_front & is_current_inside
+    is_outside_recover = is_late_front & ~is_current_inside
     
+    # 外枠（外から5頭くらい）の様子見・控えるロジック
     # 馬体重が2kg以上減っていない（= 大幅減量で勝負気配、ではない）かつ、絶対に逃げたい馬ではない場合
-    if is_outer_5 and weight_diff > -2.0 and horse['running_style'] != "ハナ絶対":
-        late_start_penalty += 0.7  # 様子見で位置を下げるペナルティ加算
-        prefix = horse['special_flag'] + " " if horse['special_flag'] else ""
-        horse['special_flag'] = (prefix + "👁️外枠様子見(控える)").strip()
+    is_outer_wait = has_past & (horse_number > (total_horses - 5)) & (weight_diff > -2.0) & can_wait
+
+    late_start_penalty = np.zeros(total_horses)
+    late_start_penalty += np.where(is_prev_local, 1.0, 0.0)
+    late_start_penalty += np.where(is_extension, 0.5, 0.0)
+    late_start_penalty += np.where(is_shortening, 0.3, 0.0)
+    late_start_penalty += np.where(is_late_start, 1.0, 0.0)
+    late_start_penalty += np.where(is_boxed_in, 1.5, 0.0)
+    late_start_penalty -= np.where(is_outside_recover, 0.5, 0.0)
+    late_start_penalty += np.where(is_outer_wait, 0.7, 0.0)  # 様子見で位置を下げるペナルティ加算
 
     final_score = base_position + weight_modifier + base_mod + late_start_penalty
-    return max(1.0, min(18.0, final_score))
+    scores = np.where(has_past, np.clip(final_score, 1.0, 18.0), 10.0 + ((horse_number - 1) * 0.05))
+    
+    flag_masks = [
+        (is_prev_local, "⚠️前走地方"),
+        (is_extension, "🐎距離延長(控える可能性)"),
+        (is_shortening, "🐢距離短縮(追走注意)"),
+        (is_boxed_in, "⚠️内枠包まれ懸念"),
+        (is_outside_recover, "🐎外枠リカバー警戒"),
+        (is_outer_wait, "👁️外枠様子見(控える)"),
+    ]
+    for i, horse in enumerate(horses):
+        horse['score'] = float(scores[i])
+        horse['running_style'] = str(running_style[i])
+        horse['max_early_speed'] = float(max_speed[i]) if not np.isnan(max_speed[i]) else DEFAULT_EARLY_SPEED
+        if has_past[i]:
+            horse['special_flag'] = " ".join(label for mask, label in flag_masks if mask[i])
+        else:
+            horse['special_flag'] = "❓データ不足"
+    
+    return horses
 
 def apply_give_up_synergy(horses, current_venue, current_dist, current_track):
-    outside_adv_courses = [("中山", 1200, "ダート"), ("東京", 1600, "ダート"), ("阪神", 1400, "ダート"), ("京都", 1400, "ダート")]
-    is_outside_adv = (current_venue, current_dist, current_track) in outside_adv_courses
+    is_outside_adv = (current_venue, current_dist, current_track) in OUTSIDE_ADV_COURSES
 
     for h in horses:
         if h.get('running_style') == "ハナ絶対":
@@ -210,7 +247,7 @@ def format_formation(sorted_horses):
     leaders, chasers, mid, backs = [], [], [], []
     top_score = sorted_horses[0]['score']
     for h in sorted_horses:
-        num_str = chr(9311 + h['horse_number']) 
+        num_str = CIRCLED_NUMBERS[h['horse_number']]
         score = h['score']
         if score <= top_score + 1.2 and len(leaders) < 3: leaders.append(num_str)
         elif score <= top_score + 4.5: chasers.append(num_str)
@@ -227,12 +264,17 @@ def format_formation(sorted_horses):
 def generate_pace_and_spread_comment(sorted_horses, current_track):
     if len(sorted_horses) < 3: return "データ不足"
     
-    top_score = sorted_horses[0]['score']
-    leaders = [h for h in sorted_horses if h['score'] <= top_score + 1.2][:3]
-    leader_nums = "、".join([chr(9311 + h['horse_number']) for h in leaders])
+    scores = np.array([h['score'] for h in sorted_horses])
+    speeds = np.array([h.get('max_early_speed', DEFAULT_EARLY_SPEED) for h in sorted_horses])
+    styles = np.array([h.get('running_style', '') for h in sorted_horses])
+    
+    top_score = scores[0]
+    leaders_mask = scores <= top_score + 1.2
+    leaders_mask[np.cumsum(leaders_mask) > 3] = False
+    leader_nums = "、".join([CIRCLED_NUMBERS[sorted_horses[i]['horse_number']] for i in np.flatnonzero(leaders_mask)])
     
     mid_idx = min(len(sorted_horses)-1, int(len(sorted_horses) * 0.6))
-    spread_gap = sorted_horses[mid_idx]['score'] - top_score
+    spread_gap = scores[mid_idx] - top_score
     
     if spread_gap >= 5.0:
         spread_text = "隊列は【縦長】"
@@ -244,13 +286,13 @@ def generate_pace_and_spread_comment(sorted_horses, current_track):
         spread_text = "【標準的な隊列】"
         spread_reason = "極端にばらけることもなく、標準的なペース配分になりそうです。"
         
-    top3_speeds = [h.get('max_early_speed', 16.1) for h in leaders]
-    avg_top_speed = sum(top3_speeds) / len(top3_speeds) if top3_speeds else 16.1
+    avg_top_speed = speeds[leaders_mask].mean()
     high_pace_threshold = 16.7 if current_track == "芝" else 16.5
     slow_pace_threshold = 16.3 if current_track == "芝" else 16.1
 
-    must_lead_count = sum(1 for h in leaders if h.get('running_style') == "ハナ絶対")
-    can_wait_count = sum(1 for h in leaders if h.get('running_style') == "控えOK")
+    leader_styles = styles[leaders_mask]
+    must_lead_count = int((leader_styles == "ハナ絶対").sum())
+    can_wait_count = int((leader_styles == "控えOK").sum())
 
     if must_lead_count >= 2 and avg_top_speed >= high_pace_threshold:
         base_cmt = f"🔥 ハイペース必至\n「何がなんでも逃げたい」馬が複数おり、{leader_nums}の激しい先行争いでテンは速くなりそうです。"
@@ -268,128 +310,171 @@ def generate_pace_and_spread_comment(sorted_horses, current_track):
     final_cmt = f"**{spread_text}**\n{spread_reason}\n\n**{base_cmt}**"
     return final_cmt
 
+# 同じ出馬表データに対する採点結果は変わらないため、TTLなしでキャッシュ（出馬表の更新ごとに増えるので件数で上限を設ける）
+@st.cache_data(max_entries=500, show_spinner=False)
+def score_race(horses, current_dist, current_venue, current_track):
+    horses = calculate_pace_scores(horses, current_dist, current_venue, current_track)
+    horses = apply_give_up_synergy(horses, current_venue, current_dist, current_track)
+    
+    scores = np.fromiter((h['score'] for h in horses), dtype=np.float64, count=len(horses))
+    sorted_horses = [horses[i] for i in np.argsort(scores, kind='stable')]
+    formation_text = format_formation(sorted_horses)
+    pace_comment = generate_pace_and_spread_comment(sorted_horses, current_track)
+    return sorted_horses, formation_text, pace_comment
+
 # ==========================================
 # 2. 競馬ブック スクレイピングロジック（キャッシュ化）
 # ==========================================
-@st.cache_data(ttl=60, show_spinner=False)
+# 12R一括取得でも接続を使い回せるよう、セッションはプロセス内で共有
+# （スクリプトは再実行のたびに評価し直されるため、st.cache_resourceでサーバープロセスに1つだけ持つ）
+@st.cache_resource(show_spinner=False)
+def get_session():
+    session = requests.Session()
+    session.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"})
+    session.mount("https://", HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])))
+    return session
+
+# 並列取得時も競馬ブックへの同時リクエストは3本まで（全セッション共通）
+@st.cache_resource(show_spinner=False)
+def get_fetch_semaphore():
+    return threading.Semaphore(3)
+
+# CSSのクラスセレクタ相当（class属性に空白区切りで含まれるか）
+HAS_CLASS = 'contains(concat(" ", normalize-space(@class), " "), " {} ")'
+
+# XPathはモジュール読み込み時に一度だけコンパイル
+XPATH_BASYO = etree.XPath(f'//td[{HAS_CLASS.format("basyo")}]')
+XPATH_KYORI = etree.XPath(f'//span[{HAS_CLASS.format("kyori")}]')
+XPATH_COURSE = etree.XPath(f'//span[{HAS_CLASS.format("course")}]')
+XPATH_HORSE_ROWS = etree.XPath(f'//table[{HAS_CLASS.format("noryoku")}]//tr[starts-with(@class, "js-umaban")]')
+XPATH_UMABAN = etree.XPath(f'.//td[{HAS_CLASS.format("umaban")}]//span')
+XPATH_BAMEI = etree.XPath(f'.//td[{HAS_CLASS.format("bamei")}]//span[{HAS_CLASS.format("kbamei")}]//a')
+XPATH_ZENSOU = etree.XPath(f'.//td[{HAS_CLASS.format("zensou")}]')
+
+# 前走セル内の各項目を取得するXPath（区切り文字に頼らず項目ごとに文字列を取り出す）
+XPATH_ZENSOU_HAS_KYORI = etree.XPath(f'boolean(.//*[{HAS_CLASS.format("kyori")}])')
+XPATH_ZENSOU_FIELDS = tuple(etree.XPath(f'string({path})') for path in (
+    f'.//*[{HAS_CLASS.format("kyori")}]',
+    f'.//*[{HAS_CLASS.format("baba")}]//img/@src',
+    f'.//*[{HAS_CLASS.format("uzenh3")}]',
+    f'.//*[{HAS_CLASS.format("tuka")}]//img/@src',
+    f'.//*[{HAS_CLASS.format("umaban")}]',
+    './/span[starts-with(@class, "cyaku")]',
+    f'.//*[{HAS_CLASS.format("ninki")}]',
+    f'.//*[{HAS_CLASS.format("negahi")}]',
+    f'.//*[{HAS_CLASS.format("batai")}]',
+))
+
+# 正規表現もモジュール読み込み時にコンパイル
+DIGITS_RE = re.compile(r'\d+')
+FLOAT_RE = re.compile(r'[\d\.]+')
+GIF_NUM_RE = re.compile(r'(\d+)\.gif')
+FRAME_RE = re.compile(r'(\d+)枠')
+RACE_ID_RE = re.compile(r'\d{10,12}')
+
+def xpath_first(xpath, node):
+    found = xpath(node)
+    return found[0] if found else None
+
+# 出馬表は出走取消などで当日も変わりうるため5分キャッシュ（st.cache_dataは呼び出しごとに複製を返すので、採点時の書き込みはキャッシュに影響しない）
+@st.cache_data(ttl=300, show_spinner=False)
 def fetch_real_data(race_id: str):
     url = f"https://s.keibabook.co.jp/cyuou/nouryoku_html_detail/{race_id}.html"
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"}
     try:
-        response = requests.get(url, headers=headers)
-        response.encoding = 'utf-8' 
-        time.sleep(1) 
-        soup = BeautifulSoup(response.text, 'html.parser')
+        with get_fetch_semaphore():
+            response = get_session().get(url, timeout=10)
+        # バイト列をそのままlxmlに渡してデコードを1回で済ませる（パーサーはスレッド間で共有しない）
+        tree = lxml.html.fromstring(response.content, parser=lxml.html.HTMLParser(encoding='utf-8'))
         
-        basyo_elem = soup.select_one('td.basyo')
-        current_venue = basyo_elem.text.strip() if basyo_elem else "不明"
+        basyo_elem = xpath_first(XPATH_BASYO, tree)
+        current_venue = basyo_elem.text_content().strip() if basyo_elem is not None else "不明"
         if current_venue == "不明": return None, 1600, "", "芝", "出馬表データが見つかりません。"
         
-        kyori_elem = soup.select_one('span.kyori')
-        course_elem = soup.select_one('span.course')
+        kyori_elem = xpath_first(XPATH_KYORI, tree)
+        course_elem = xpath_first(XPATH_COURSE, tree)
         
-        current_dist = int(re.search(r'\d+', kyori_elem.text).group()) if kyori_elem else 1600
-        current_track = "ダート" if course_elem and "ダ" in course_elem.text else "芝"
+        current_dist = int(DIGITS_RE.search(kyori_elem.text_content()).group()) if kyori_elem is not None else 1600
+        current_track = "ダート" if course_elem is not None and "ダ" in course_elem.text_content() else "芝"
 
         horses_data = []
-        trs = soup.select('table.noryoku tr[class^="js-umaban"]')
+        trs = XPATH_HORSE_ROWS(tree)
         if not trs:
             return None, current_dist, current_venue, current_track, "出走馬データが見つかりません。"
 
         for tr in trs:
-            umaban_elem = tr.select_one('td.umaban span')
-            if not umaban_elem: continue
-            horse_num = int(umaban_elem.text.strip())
+            umaban_elem = xpath_first(XPATH_UMABAN, tr)
+            if umaban_elem is None: continue
+            try:
+                horse_num = int(umaban_elem.text_content().strip())
+            except ValueError:
+                continue
             
-            bamei_elem = tr.select_one('td.bamei span.kbamei a')
-            horse_name = bamei_elem.text.strip() if bamei_elem else "不明"
+            bamei_elem = xpath_first(XPATH_BAMEI, tr)
+            horse_name = bamei_elem.text_content().strip() if bamei_elem is not None else "不明"
             
-            past_races = []
+            zensou_tds = XPATH_ZENSOU(tr)
+            past_races = np.empty(len(zensou_tds), dtype=PAST_DTYPE)
+            n_past = 0
             current_weight = 480.0 
             
-            for td in tr.select('td.zensou'):
-                if not td.select_one('.kyori'): continue
+            for td in zensou_tds:
+                if not XPATH_ZENSOU_HAS_KYORI(td): continue
+                (k_text, baba_src, e3f_text, tuka_src, z_umaban_text,
+                 cyaku_text, ninki_text, v_text, batai_text) = (xpath(td) for xpath in XPATH_ZENSOU_FIELDS)
                 
-                k_text = td.select_one('.kyori').text
-                dist_m = re.search(r'\d+', k_text)
+                dist_m = DIGITS_RE.search(k_text)
                 dist = int(dist_m.group()) if dist_m else current_dist
                 track = "ダート" if "ダ" in k_text else "芝"
                 
-                baba_img = td.select_one('.baba img')
                 baba_cond = "良"
-                if baba_img:
-                    src = baba_img.get('src', '')
-                    if 'ryo' in src: baba_cond = '良'
-                    elif 'yaya' in src: baba_cond = '稍'
-                    elif 'omo' in src: baba_cond = '重'
-                    elif 'huryo' in src: baba_cond = '不良'
+                if 'ryo' in baba_src: baba_cond = '良'
+                elif 'yaya' in baba_src: baba_cond = '稍'
+                elif 'omo' in baba_src: baba_cond = '重'
+                elif 'huryo' in baba_src: baba_cond = '不良'
                 
-                early_3f_span = td.select_one('.uzenh3')
                 early_3f = np.nan
-                if early_3f_span:
-                    e3f_text = early_3f_span.text.strip()
-                    e3f_match = re.search(r'[\d\.]+', e3f_text)
-                    if e3f_match:
-                        try:
-                            val = float(e3f_match.group())
-                            if 25.0 <= val <= 60.0:
-                                early_3f = val
-                        except:
-                            pass
+                e3f_match = FLOAT_RE.search(e3f_text)
+                if e3f_match:
+                    try:
+                        val = float(e3f_match.group())
+                        if 25.0 <= val <= 60.0:
+                            early_3f = val
+                    except:
+                        pass
                 
-                tuka_imgs = td.select('.tuka img')
                 first_corner = 7
-                is_late_start = False
-                if tuka_imgs:
-                    src = tuka_imgs[0].get('src', '')
-                    m = re.search(r'(\d+)\.gif', src)
-                    if m: first_corner = int(m.group(1))
-                    if 'maru' in src: is_late_start = True 
+                m = GIF_NUM_RE.search(tuka_src)
+                if m: first_corner = int(m.group(1))
+                is_late_start = 'maru' in tuka_src
                         
-                umaban_span = td.select_one('.umaban')
-                past_frame = 4
-                if umaban_span:
-                    frame_m = re.search(r'(\d+)枠', umaban_span.text)
-                    if frame_m: past_frame = int(frame_m.group(1))
-
-                cyaku_span = td.select_one('span[class^="cyaku"]')
-                finish_pos = int(re.search(r'\d+', cyaku_span.text).group()) if cyaku_span and re.search(r'\d+', cyaku_span.text) else 5
+                frame_m = FRAME_RE.search(z_umaban_text)
+                past_frame = int(frame_m.group(1)) if frame_m else 4
+
+                cyaku_m = DIGITS_RE.search(cyaku_text)
+                finish_pos = int(cyaku_m.group()) if cyaku_m else 5
                 
-                ninki_span = td.select_one('.ninki')
-                popularity = int(re.search(r'\d+', ninki_span.text).group()) if ninki_span and re.search(r'\d+', ninki_span.text) else 5
+                ninki_m = DIGITS_RE.search(ninki_text)
+                popularity = int(ninki_m.group()) if ninki_m else 5
                 
-                negahi_spans = td.select('.negahi')
-                p_venue = current_venue
-                if negahi_spans:
-                    v_text = negahi_spans[0].text
-                    venue_map = {"東":"東京", "中":"中山", "京":"京都", "阪":"阪神", "名":"中京", "新":"新潟", "福":"福島", "小":"小倉", "札":"札幌", "函":"函館"}
-                    local_venue_map = {"盛":"盛岡", "水":"水沢", "浦":"浦和", "船":"船橋", "大":"大井", "川":"川崎", "金":"金沢", "笠":"笠松", "園":"園田", "姫":"姫路", "高":"高知", "佐":"佐賀"}
-                    for v_key, v_val in venue_map.items():
-                        if v_key in v_text:
-                            p_venue = v_val
-                            break
-                    for v_key, v_val in local_venue_map.items():
-                        if v_key in v_text:
-                            p_venue = v_val
-                            break
+                # 略称は1文字なので、先頭から1文字ずつ辞書を引く
+                p_venue = next((VENUE_ABBR_MAP[c] for c in v_text if c in VENUE_ABBR_MAP), current_venue)
                 
-                batai_span = td.select_one('.batai')
-                weight = float(batai_span.text.strip()) if batai_span else 480.0
+                batai_text = batai_text.strip()
+                weight = float(batai_text) if batai_text else 480.0
                 
-                if len(past_races) == 0:
+                if n_past == 0:
                     current_weight = weight
                 
-                past_races.append({
-                    'venue': p_venue, 'track_type': track, 'distance': dist,
-                    'track_condition': baba_cond, 'finish_position': finish_pos,
-                    'popularity': popularity, 'early_3f': early_3f,
-                    'first_corner_pos': first_corner, 'is_late_start': is_late_start,
-                    'past_frame': past_frame, 'weight': weight
-                })
+                past_races[n_past] = (
+                    VENUE_CODES.get(p_venue, -1), TRACK_CODES[track], dist, CONDITION_CODES[baba_cond], finish_pos, popularity, early_3f,
+                    first_corner, is_late_start, past_frame, weight
+                )
+                n_past += 1
 
             horses_data.append({
                 'horse_number': horse_num, 'horse_name': horse_name,
-                'current_weight': current_weight, 'past_races': past_races,
+                'current_weight': current_weight,
+                'past_races': past_races[:n_past],
                 'score': 0.0, 'special_flag': ""
             })
 
@@ -400,6 +485,13 @@ def fetch_real_data(race_id: str):
     except Exception as e:
         return None, 1600, "", "芝", f"エラー: {e}\n{traceback.format_exc()}"
 
+def predict_race(race_id: str):
+    # 1レース分の取得〜採点（スレッドプールから呼ばれるため、ここでは描画しない）
+    horses, current_dist, current_venue, current_track, error_msg = fetch_real_data(race_id)
+    if error_msg:
+        return None, current_dist, current_venue, current_track, error_msg
+    return score_race(horses, current_dist, current_venue, current_track), current_dist, current_venue, current_track, None
+
 # ==========================================
 # 3. スマホ対応UI
 # ==========================================
@@ -416,9 +508,9 @@ with st.container(border=True):
     
     st.markdown("**🎯 予想したいレースを選択（複数可）**")
     try:
-        selected_races = st.pills("レース番号", options=list(range(1, 13)), default=[9, 10], format_func=lambda x: f"{x}R", selection_mode="multi")
+        selected_races = st.pills("レース番号", options=RACE_NUMBERS, default=[9, 10], format_func=lambda x: f"{x}R", selection_mode="multi")
     except TypeError:
-        selected_races = st.multiselect("レース番号", options=list(range(1, 13)), default=[9, 10], format_func=lambda x: f"{x}R")
+        selected_races = st.multiselect("レース番号", options=RACE_NUMBERS, default=[9, 10], format_func=lambda x: f"{x}R")
 
     if not isinstance(selected_races, list):
         selected_races = [selected_races] if selected_races else []
@@ -429,6 +521,9 @@ with st.container(border=True):
     with col2:
         execute_all_btn = st.button("🌟 全12Rを一括予想", type="secondary", use_container_width=True)
 
+    if st.button("🧹 キャッシュをクリア", use_container_width=True):
+        st.cache_data.clear()
+
 # 実行トリガーの判定 (セッションステートを削除し、ボタン押下時のみ動作)
 run_inference = False
 target_races = []
@@ -436,8 +531,8 @@ base_race_id = ""
 
 if execute_all_btn:
     run_inference = True
-    target_races = list(range(1, 13))
-    match = re.search(r'\d{10,12}', base_url_input)
+    target_races = RACE_NUMBERS
+    match = RACE_ID_RE.search(base_url_input)
     base_race_id = match.group()[:10] if match else ""
 elif execute_btn:
     if not selected_races:
@@ -445,7 +540,7 @@ elif execute_btn:
     else:
         run_inference = True
         target_races = selected_races
-        match = re.search(r'\d{10,12}', base_url_input)
+        match = RACE_ID_RE.search(base_url_input)
         base_race_id = match.group()[:10] if match else ""
 
 # 推論・描画を実行
@@ -453,28 +548,27 @@ if run_inference:
     if not base_race_id:
         st.error("有効な競馬ブックのレースIDが見つかりません。")
     else:
-        for race_num in sorted(target_races):
-            target_race_id = f"{base_race_id}{race_num:02d}"
+        race_nums = sorted(target_races)
+        
+        # 取得・採点はレースごとに独立しているため並列に実行し、描画はメインスレッドでレース順に行う
+        results = {}
+        with st.spinner(f"{len(race_nums)}レースのデータを解析中..."):
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                futures = {executor.submit(predict_race, f"{base_race_id}{race_num:02d}"): race_num for race_num in race_nums}
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+
+        for race_num in race_nums:
+            scored, current_dist, current_venue, current_track, error_msg = results[race_num]
             
             st.markdown(f"### 🏁 {race_num}R")
             
-            with st.spinner(f"{race_num}R のデータを解析中..."):
-                horses, current_dist, current_venue, current_track, error_msg = fetch_real_data(target_race_id)
+            if error_msg:
+                st.warning(f"{error_msg}")
+                continue
                 
-                if error_msg:
-                    st.warning(f"{error_msg}")
-                    continue
-                    
-                total_horses = len(horses)
-                
-                for horse in horses:
-                    horse['score'] = calculate_pace_score(horse, current_dist, current_venue, current_track, total_horses)
-                    
-                horses = apply_give_up_synergy(horses, current_venue, current_dist, current_track)
-                
-                sorted_horses = sorted(horses, key=lambda x: x['score'])
-                formation_text = format_formation(sorted_horses)
-                pace_comment = generate_pace_and_spread_comment(sorted_horses, current_track)
+            sorted_horses, formation_text, pace_comment = scored
+            total_horses = len(sorted_horses)
 
             st.info(f"📏 条件: **{current_venue} {current_track}{current_dist}m** ({total_horses}頭立て)")
             
@@ -485,13 +579,13 @@ if run_inference:
             st.write(pace_comment)
             
             with st.expander(f"📊 {race_num}R の詳細データを見る"):
-                df_result = pd.DataFrame([{
-                    "馬番": h['horse_number'],
-                    "馬名": h['horse_name'],
-                    "スコア": round(h['score'], 2),
-                    "戦法": h.get('running_style', ''),
-                    "特記事項": h.get('special_flag', '')
-                } for h in sorted_horses])
+                df_result = pd.DataFrame({
+                    "馬番": [h['horse_number'] for h in sorted_horses],
+                    "馬名": [h['horse_name'] for h in sorted_horses],
+                    "スコア": [round(h['score'], 2) for h in sorted_horses],
+                    "戦法": [h.get('running_style', '') for h in sorted_horses],
+                    "特記事項": [h.get('special_flag', '') for h in sorted_horses],
+                })
                 st.dataframe(df_result, use_container_width=True, hide_index=True)
             
             st.markdown("<br>", unsafe_allow_html=True)